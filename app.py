@@ -1,6 +1,9 @@
+import functools
 import os
 import hashlib
+import shutil
 import sqlite3
+import tempfile
 from datetime import datetime, date, timedelta
 from pathlib import Path
 
@@ -21,7 +24,12 @@ DB_PATH = BASE_DIR / "videos.db"
 UPLOAD_DIR = BASE_DIR / "uploads"
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
+# Process umask, read once at import (os.umask can only be read by setting it)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
 ALLOWED_EXTENSIONS = {"mp4", "mov", "avi", "mkv", "webm", "m4v"}
+ALLOWED_SUFFIXES = tuple("." + ext for ext in ALLOWED_EXTENSIONS)
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = os.environ.get("FLASK_SECRET_KEY", "dev-secret-key")
@@ -31,6 +39,8 @@ app.config.update(
     SESSION_COOKIE_SAMESITE="Lax",
     SESSION_COOKIE_SECURE=False,  # set True when using HTTPS
     PERMANENT_SESSION_LIFETIME=60 * 60 * 12,  # 12 hours
+    # Let a fronting Apache (mod_xsendfile) serve files via X-Sendfile
+    USE_X_SENDFILE=os.environ.get("USE_X_SENDFILE", "").lower() in {"1", "true", "yes"},
 )
 
 # Auth config from environment
@@ -52,6 +62,12 @@ def get_db():
     if "db" not in g:
         g.db = sqlite3.connect(DB_PATH)
         g.db.row_factory = sqlite3.Row
+        # WAL: fewer fsyncs on commit and readers don't block on writers
+        g.db.execute("PRAGMA journal_mode=WAL")
+        g.db.execute("PRAGMA synchronous=NORMAL")
+        g.db.execute("PRAGMA temp_store=MEMORY")
+        g.db.execute("PRAGMA cache_size=-20000")  # ~20 MB
+        g.db.execute("PRAGMA mmap_size=268435456")  # 256 MB
     return g.db
 
 
@@ -61,14 +77,13 @@ def close_db(exception):
     if db is not None:
         db.close()
 
-@app.before_request
-def init_db():
-    db = get_db()
+def _init_schema(db):
     db.execute(
         """
         CREATE TABLE IF NOT EXISTS videos (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             file_hash TEXT NOT NULL,
+            file_name TEXT,
             original_filename TEXT NOT NULL,
             name TEXT,
             caption TEXT,
@@ -94,8 +109,10 @@ def init_db():
         );
         """
     )
-    db.execute("CREATE INDEX IF NOT EXISTS idx_video_uploads_video ON video_uploads(video_id);")
     db.execute("CREATE INDEX IF NOT EXISTS idx_video_uploads_status ON video_uploads(status);")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_vu_video_status ON video_uploads(video_id, status);")
+    # Subsumed by idx_vu_video_status
+    db.execute("DROP INDEX IF EXISTS idx_video_uploads_video;")
     # Server-side sessions table for stronger auth
     db.execute(
         """
@@ -108,21 +125,144 @@ def init_db():
         );
         """
     )
-    db.execute("CREATE INDEX IF NOT EXISTS idx_videos_taken_at ON videos(taken_at);")
     db.execute("CREATE INDEX IF NOT EXISTS idx_videos_file_hash ON videos(file_hash);")
+    # Session hashes moved from SHA-256 to BLAKE2b; old ones can't be rehashed
+    # without the raw token, so drop them (users log in again once)
+    db.execute("DELETE FROM sessions WHERE length(token_hash) != ?", (TOKEN_HASH_LEN,))
+    # Files are stored as <hash>.<ext>; older databases lack the column
+    cols = {row["name"] for row in db.execute("PRAGMA table_info(videos)")}
+    if "file_name" not in cols:
+        db.execute("ALTER TABLE videos ADD COLUMN file_name TEXT")
+    # Covers the uploader's due-videos scan; subsumes the old taken_at index
+    db.execute("CREATE INDEX IF NOT EXISTS idx_videos_due_cover ON videos(taken_at, id, file_name, caption);")
+    db.execute("DROP INDEX IF EXISTS idx_videos_taken_at;")
     db.commit()
+    _migrate_file_names(db)
+    _init_daily_counts(db)
+
+
+def _init_daily_counts(db):
+    """Per-day video counts for the calendar, kept current by triggers on videos.
+
+    Runs on every startup inside one write transaction, so the table, its
+    triggers and the counts are created together and can't be left half done.
+    """
+    if db.in_transaction:
+        db.commit()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS daily_video_counts (
+                day TEXT PRIMARY KEY, -- YYYY-MM-DD
+                cnt INTEGER NOT NULL DEFAULT 0
+            );
+            """
+        )
+        db.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_videos_count_insert AFTER INSERT ON videos
+            BEGIN
+                INSERT INTO daily_video_counts (day, cnt) VALUES (substr(NEW.taken_at, 1, 10), 1)
+                ON CONFLICT(day) DO UPDATE SET cnt = cnt + 1;
+            END;
+            """
+        )
+        db.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_videos_count_delete AFTER DELETE ON videos
+            BEGIN
+                UPDATE daily_video_counts SET cnt = cnt - 1 WHERE day = substr(OLD.taken_at, 1, 10);
+                DELETE FROM daily_video_counts WHERE day = substr(OLD.taken_at, 1, 10) AND cnt <= 0;
+            END;
+            """
+        )
+        db.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_videos_count_update AFTER UPDATE OF taken_at ON videos
+            WHEN substr(OLD.taken_at, 1, 10) != substr(NEW.taken_at, 1, 10)
+            BEGIN
+                UPDATE daily_video_counts SET cnt = cnt - 1 WHERE day = substr(OLD.taken_at, 1, 10);
+                DELETE FROM daily_video_counts WHERE day = substr(OLD.taken_at, 1, 10) AND cnt <= 0;
+                INSERT INTO daily_video_counts (day, cnt) VALUES (substr(NEW.taken_at, 1, 10), 1)
+                ON CONFLICT(day) DO UPDATE SET cnt = cnt + 1;
+            END;
+            """
+        )
+        # Rebuild from existing rows; the write lock keeps inserts out meanwhile
+        db.execute("DELETE FROM daily_video_counts")
+        db.execute(
+            """
+            INSERT INTO daily_video_counts (day, cnt)
+            SELECT substr(taken_at, 1, 10), COUNT(*) FROM videos GROUP BY 1
+            """
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+
+def _migrate_file_names(db):
+    """Move files stored as bare <hash> to <hash>.<ext> and record file_name."""
+    rows = db.execute("SELECT id, file_hash, original_filename FROM videos WHERE file_name IS NULL").fetchall()
+    if not rows:
+        return
+    legacy = set()
+    for row in rows:
+        file_name = row["file_hash"] + Path(row["original_filename"]).suffix.lower()
+        src = UPLOAD_DIR / row["file_hash"]
+        dst = UPLOAD_DIR / file_name
+        if src != dst and src.exists():
+            # The old TikTok shim may have left dst as a symlink to src, which
+            # would dangle once src is removed; replace it with a real file
+            if dst.is_symlink():
+                dst.unlink()
+            # Link rather than rename: rows sharing a hash may differ in extension
+            if not dst.exists():
+                try:
+                    os.link(src, dst)
+                except OSError:
+                    shutil.copyfile(src, dst)
+            legacy.add(src)
+        db.execute("UPDATE videos SET file_name = ? WHERE id = ?", (file_name, row["id"]))
+    db.commit()
+    for path in legacy:
+        # Drop .mp4 aliases the TikTok shim made for other extensions
+        alias = path.with_name(path.name + ".mp4")
+        if not db.execute("SELECT 1 FROM videos WHERE file_name = ?", (alias.name,)).fetchone():
+            alias.unlink(missing_ok=True)
+        path.unlink(missing_ok=True)
+
+
+def video_file_path(row) -> Path:
+    return UPLOAD_DIR / row["file_name"]
 
 
 # -----------------------
 # Auth helpers & guard
 # -----------------------
 
+LAST_SEEN_INTERVAL = timedelta(seconds=60)
+
+# Length of a _tok_hash hex digest; older rows hold 64-char SHA-256 digests
+TOKEN_HASH_LEN = 40
+
+
+def _tok_hash(token: str) -> str:
+    # Tokens carry 256 bits of entropy, so a fast 160-bit BLAKE2b digest suffices
+    return hashlib.blake2b(token.encode("utf-8"), digest_size=20).hexdigest()
+
+
 def _get_session_row_by_token(token: str):
     if not token:
         return None
-    th = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    th = _tok_hash(token)
     db = get_db()
     row = db.execute("SELECT * FROM sessions WHERE token_hash = ? AND username = ?", (th, AUTH_USERNAME)).fetchone()
+    # Don't trust the SQL match alone; compare in constant time like login()
+    if row is not None and not hmac.compare_digest(row["token_hash"], th):
+        return None
     return row
 
 
@@ -130,10 +270,13 @@ def is_authenticated() -> bool:
     token = session.get("sid")
     row = _get_session_row_by_token(token)
     if row:
-        # Update last_seen occasionally
+        # Update last_seen at most once per LAST_SEEN_INTERVAL to avoid a write per request
+        now = datetime.utcnow()
         try:
-            get_db().execute("UPDATE sessions SET last_seen = ? WHERE id = ?", (datetime.utcnow().isoformat(timespec="seconds"), row["id"]))
-            get_db().commit()
+            last_seen = datetime.fromisoformat(row["last_seen"]) if row["last_seen"] else None
+            if last_seen is None or now - last_seen > LAST_SEEN_INTERVAL:
+                get_db().execute("UPDATE sessions SET last_seen = ? WHERE id = ?", (now.isoformat(timespec="seconds"), row["id"]))
+                get_db().commit()
         except Exception:
             pass
         return True
@@ -157,20 +300,42 @@ def require_login():
 # -----------------------
 
 def allowed_file(filename: str) -> bool:
-    if "." not in filename:
-        return False
-    ext = filename.rsplit(".", 1)[1].lower()
-    return ext in ALLOWED_EXTENSIONS
+    return filename.lower().endswith(ALLOWED_SUFFIXES)
 
 
-def sha256_file(file_storage) -> str:
-    # Compute SHA256 as we stream the file once
-    file_storage.stream.seek(0)
+def hash_and_save(stream, dst_dir: Path, ext: str):
+    """Stream upload to dst_dir/<sha256>.<ext> in a single pass; return (hash, file name)."""
     h = hashlib.sha256()
-    for chunk in iter(lambda: file_storage.stream.read(8192), b""):
-        h.update(chunk)
-    file_storage.stream.seek(0)  # reset for saving
-    return h.hexdigest()
+    tmp = tempfile.NamedTemporaryFile(dir=dst_dir, delete=False)
+    try:
+        with tmp:
+            while chunk := stream.read(1 << 20):
+                h.update(chunk)
+                tmp.write(chunk)
+        file_hash = h.hexdigest()
+        file_name = f"{file_hash}.{ext}"
+        out_path = dst_dir / file_name
+        if out_path.exists():
+            # Same content already stored; keep the existing file
+            os.unlink(tmp.name)
+            return file_hash, file_name
+        # Same content stored under another extension: hardlink to it
+        sibling = next(dst_dir.glob(f"{file_hash}.*"), None)
+        if sibling is not None:
+            try:
+                os.link(sibling, out_path)
+                os.unlink(tmp.name)
+                return file_hash, file_name
+            except OSError:
+                pass
+        # Temp files are created 0600; give stored uploads the usual
+        # umask-based mode so a fronting web server can read them
+        os.chmod(tmp.name, 0o666 & ~_UMASK)
+        os.replace(tmp.name, out_path)
+    except Exception:
+        Path(tmp.name).unlink(missing_ok=True)
+        raise
+    return file_hash, file_name
 
 
 def parse_eu_datetime(date_str: str, time_str: str) -> datetime:
@@ -194,6 +359,7 @@ def ensure_not_past(dt: datetime) -> bool:
     return dt >= datetime.now()
 
 
+@functools.lru_cache(maxsize=256)
 def month_range(year: int, month: int):
     start = date(year, month, 1)
     if month == 12:
@@ -208,16 +374,24 @@ def fetch_month_counts(year: int, month: int) -> dict:
     db = get_db()
     start, end = month_range(year, month)
     cur = db.execute(
+        "SELECT day, cnt FROM daily_video_counts WHERE day BETWEEN ? AND ?",
+        (start.isoformat(), end.isoformat()),
+    )
+    return {row["day"]: row["cnt"] for row in cur.fetchall()}
+
+
+def fetch_month_videos(year: int, month: int) -> list:
+    """Return the month's videos ordered by taken_at."""
+    db = get_db()
+    start, end = month_range(year, month)
+    return db.execute(
         """
-        SELECT substr(taken_at, 1, 10) as day, COUNT(*) as cnt
-        FROM videos
+        SELECT * FROM videos
         WHERE date(taken_at) BETWEEN date(?) AND date(?)
-        GROUP BY day
+        ORDER BY taken_at ASC
         """,
         (start.isoformat(), end.isoformat()),
-    )
-    out = {row["day"]: row["cnt"] for row in cur.fetchall()}
-    return out
+    ).fetchall()
 
 
 # -----------------------
@@ -233,11 +407,12 @@ def login():
             session.clear()
             # Create a random session token and store its hash server-side
             token = secrets.token_urlsafe(32)
-            token_hash = hashlib.sha256(token.encode("utf-8")).hexdigest()
+            token_hash = _tok_hash(token)
+            now = datetime.utcnow().isoformat(timespec="seconds")
             db = get_db()
             db.execute(
                 "INSERT INTO sessions (username, token_hash, created_at, last_seen) VALUES (?, ?, ?, ?)",
-                (username, token_hash, datetime.utcnow().isoformat(timespec="seconds"), datetime.utcnow().isoformat(timespec="seconds")),
+                (username, token_hash, now, now),
             )
             db.commit()
             # Store only the opaque token in the client session
@@ -259,7 +434,7 @@ def logout():
     token = session.get("sid")
     if token:
         try:
-            th = hashlib.sha256(token.encode("utf-8")).hexdigest()
+            th = _tok_hash(token)
             db = get_db()
             db.execute("DELETE FROM sessions WHERE token_hash = ?", (th,))
             db.commit()
@@ -273,29 +448,19 @@ def logout():
 @app.route("/")
 def index():
     # Determine current month from query params or today
+    today = datetime.today()
     try:
-        year = int(request.args.get("year") or datetime.today().year)
-        month = int(request.args.get("month") or datetime.today().month)
+        year = int(request.args.get("year") or today.year)
+        month = int(request.args.get("month") or today.month)
         # clamp
         if not (1 <= month <= 12):
             raise ValueError
     except ValueError:
-        year = datetime.today().year
-        month = datetime.today().month
+        year = today.year
+        month = today.month
 
     counts = fetch_month_counts(year, month)
-
-    # List videos for this month ordered by taken_at desc
-    db = get_db()
-    start, end = month_range(year, month)
-    videos = db.execute(
-        """
-        SELECT * FROM videos
-        WHERE date(taken_at) BETWEEN date(?) AND date(?)
-        ORDER BY taken_at ASC
-        """,
-        (start.isoformat(), end.isoformat()),
-    ).fetchall()
+    videos = fetch_month_videos(year, month)
 
     # For intensity scale
     max_count = max(counts.values()) if counts else 0
@@ -312,16 +477,23 @@ def index():
     start, end = month_range(year, month)
     all_days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
 
-    # Per-video success counts
+    # Per-video success counts, limited to this month's videos
+    db = get_db()
     succ_by_video = {
         row[0]: row[1]
         for row in db.execute(
             """
-            SELECT video_id, COUNT(*) AS succ
-            FROM video_uploads
-            WHERE status = 'success'
-            GROUP BY video_id
-            """
+            SELECT vu.video_id, COUNT(*) AS succ
+            FROM videos v
+            CROSS JOIN video_uploads vu ON vu.video_id = v.id
+            WHERE vu.status = 'success'
+              AND v.taken_at >= ? AND v.taken_at < ?
+            GROUP BY vu.video_id
+            """,
+            # taken_at is ISO YYYY-MM-DDTHH:MM, so plain string bounds select
+            # the month and can use the taken_at index; CROSS JOIN keeps
+            # SQLite driving the join from videos
+            (start.isoformat(), (end + timedelta(days=1)).isoformat()),
         ).fetchall()
     }
     
@@ -337,7 +509,7 @@ def index():
         prev_month=prev_month,
         next_year=next_year,
         next_month=next_month,
-        today=date.today(),
+        today=today.date(),
         upload_success_by_video=succ_by_video,
     )
 
@@ -367,22 +539,20 @@ def upload():
         flash("Invalid date/time. Use DD.MM.YY and HH:MM.", "error")
         return redirect(url_for("index"))
 
-    file_hash = sha256_file(file)
-
-    # Store by hash without extension
-    out_path = UPLOAD_DIR / file_hash
-    if not out_path.exists():
-        # Save once
-        file.save(out_path)
+    # Hash and store as <hash>.<ext> in one pass (extension validated above)
+    ext = file.filename.rsplit(".", 1)[1].lower()
+    file_hash, file_name = hash_and_save(file.stream, UPLOAD_DIR, ext)
+    out_path = UPLOAD_DIR / file_name
 
     db = get_db()
     db.execute(
         """
-        INSERT INTO videos (file_hash, original_filename, name, caption, taken_at, uploaded_at, size_bytes, mime_type)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        INSERT INTO videos (file_hash, file_name, original_filename, name, caption, taken_at, uploaded_at, size_bytes, mime_type)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
         """,
         (
             file_hash,
+            file_name,
             secure_filename(file.filename),
             name,
             caption,
@@ -463,20 +633,26 @@ def edit_video(video_id: int):
 @app.route("/video/<int:video_id>/delete", methods=["POST"])
 def delete_video(video_id: int):
     db = get_db()
-    row = db.execute("SELECT * FROM videos WHERE id = ?", (video_id,)).fetchone()
-    if not row:
-        abort(404)
-
-    file_hash = row["file_hash"]
-
-    # Delete DB row
-    db.execute("DELETE FROM videos WHERE id = ?", (video_id,))
-    db.commit()
-
-    # If no other records reference this hash, remove the file
-    others = db.execute("SELECT COUNT(*) as c FROM videos WHERE file_hash = ?", (file_hash,)).fetchone()
+    # Lookup, delete and reference count in one transaction (single commit)
+    # A swallowed error earlier in the request (e.g. a locked last_seen
+    # update) can leave an implicit transaction open; BEGIN would then fail
+    if db.in_transaction:
+        db.rollback()
+    with db:
+        db.execute("BEGIN IMMEDIATE")
+        row = db.execute("SELECT * FROM videos WHERE id = ?", (video_id,)).fetchone()
+        if not row:
+            abort(404)
+        db.execute("DELETE FROM videos WHERE id = ?", (video_id,))
+        # file_hash narrows via idx_videos_file_hash; file_name picks the stored file
+        others = db.execute(
+            "SELECT COUNT(*) as c FROM videos WHERE file_hash = ? AND file_name = ?",
+            (row["file_hash"], row["file_name"]),
+        ).fetchone()
+
+    # If no other records reference this file, remove it
     if others and others["c"] == 0:
-        path = UPLOAD_DIR / file_hash
+        path = video_file_path(row)
         if path.exists():
             try:
                 path.unlink()
@@ -499,18 +675,25 @@ def stream_video(video_id: int):
     row = db.execute("SELECT * FROM videos WHERE id = ?", (video_id,)).fetchone()
     if not row:
         abort(404)
-    path = UPLOAD_DIR / row["file_hash"]
+    path = video_file_path(row)
     if not path.exists():
         abort(404)
-    # Simple send_file (not range requests)
+    # send_file answers conditional and Range requests by default
     return send_file(path, mimetype=row["mime_type"], as_attachment=False)
 
 
 # -----------------------
 # App startup
 # -----------------------
-if __name__ == "__main__":
-    # Ensure DB is initialized within an app context when running directly
+# Create the schema once at startup instead of on every request
+if not os.environ.get("SKIP_DB_INIT"):
     with app.app_context():
-        init_db()
+        _init_schema(get_db())
+
+
+if __name__ == "__main__":
+    # Schema is normally created at import above; only do it here if that was skipped
+    if os.environ.get("SKIP_DB_INIT"):
+        with app.app_context():
+            _init_schema(get_db())
     app.run(host="0.0.0.0", port=5000, debug=True)
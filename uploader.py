@@ -1,5 +1,7 @@
 import os
+import queue
 import sqlite3
+import threading
 import time
 from datetime import datetime
 from pathlib import Path
@@ -17,6 +19,8 @@ load_dotenv(BASE_DIR / ".env")
 DB_PATH = BASE_DIR / "videos.db"
 UPLOAD_DIR = BASE_DIR / "uploads"
 
+POLL_INTERVAL = 30  # seconds
+
 # Map of service -> env var that enables it (see special-case in enabled_services for TikTok)
 SERVICE_ENV_MAP: Dict[str, str] = {
     "tiktok": "TIKTOK_COOKIES_FILE",
@@ -31,6 +35,12 @@ SERVICE_ENV_MAP: Dict[str, str] = {
 def get_db() -> sqlite3.Connection:
     db = sqlite3.connect(DB_PATH)
     db.row_factory = sqlite3.Row
+    # Keep in sync with app.get_db
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.execute("PRAGMA cache_size=-20000")  # ~20 MB
+    db.execute("PRAGMA mmap_size=268435456")  # 256 MB
     return db
 
 
@@ -50,8 +60,10 @@ def ensure_schema(db: sqlite3.Connection) -> None:
         );
         """
     )
-    db.execute("CREATE INDEX IF NOT EXISTS idx_video_uploads_video ON video_uploads(video_id);")
     db.execute("CREATE INDEX IF NOT EXISTS idx_video_uploads_status ON video_uploads(status);")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_vu_video_status ON video_uploads(video_id, status);")
+    # Subsumed by idx_vu_video_status
+    db.execute("DROP INDEX IF EXISTS idx_video_uploads_video;")
     db.commit()
 
 
@@ -59,6 +71,11 @@ def ensure_schema(db: sqlite3.Connection) -> None:
 # Service helpers
 # -----------------------
 
+def video_file_path(row: sqlite3.Row) -> Path:
+    # Stored as <hash>.<ext>; see app.video_file_path
+    return UPLOAD_DIR / row["file_name"]
+
+
 def enabled_services() -> List[str]:
     services = []
     for svc, env_name in SERVICE_ENV_MAP.items():
@@ -83,6 +100,25 @@ def has_attempt(db: sqlite3.Connection, video_id: int, service: str) -> bool:
     return cur.fetchone() is not None
 
 
+def wait_for_change(db: sqlite3.Connection | None, timeout: float) -> None:
+    """
+    Sleep up to timeout seconds, returning early when another connection
+    commits to the database (PRAGMA data_version changes). Falls back to a
+    plain sleep without a connection or if the database errors.
+    """
+    deadline = time.monotonic() + timeout
+    try:
+        if db is None:
+            raise sqlite3.OperationalError("no watcher connection")
+        version = db.execute("PRAGMA data_version").fetchone()[0]
+        while (remaining := deadline - time.monotonic()) > 0:
+            time.sleep(min(1.0, remaining))
+            if db.execute("PRAGMA data_version").fetchone()[0] != version:
+                break
+    except sqlite3.Error:
+        time.sleep(max(0.0, deadline - time.monotonic()))
+
+
 def mark_result(
     db: sqlite3.Connection,
     video_id: int,
@@ -109,36 +145,55 @@ def mark_result(
 
 
 # -----------------------
-# Upload implementations (stubs)
+# Upload implementations
 # -----------------------
 
-def upload_to_service(service: str, video_path: Path, caption: str | None) -> None:
-    if service == "tiktok":
-        print("[uploader] uploading to tiktok")
-        cookies_file = os.environ.get("TIKTOK_COOKIES_FILE")
-        description = caption or ""
+class Uploader:
+    """
+    Uploads videos to the enabled services. Logins and credentials are set up
+    lazily on first use and reused for the lifetime of the instance.
+    Safe to share between threads: uploads to the same service are serialized,
+    different services run concurrently.
+    """
 
-        # Ensure the path we pass has a valid video extension
-        path_for_upload = video_path
-        if not path_for_upload.suffix:
-            mp4_path = path_for_upload.with_suffix(".mp4")
-            if not mp4_path.exists():
+    def __init__(self) -> None:
+        self._ig_client: Client | None = None
+        self._tiktok_cookies: str | None = None
+        self._locks: Dict[str, threading.Lock] = {}
+
+    def upload(self, service: str, video_path: Path, caption: str | None) -> None:
+        with self._locks.setdefault(service, threading.Lock()):
+            if service == "tiktok":
+                self._upload_tiktok(video_path, caption)
+            elif service == "instagram":
                 try:
-                    os.link(path_for_upload, mp4_path)
-                except OSError:
-                    # Fallback: simple copy without extra imports
-                    mp4_path.write_bytes(path_for_upload.read_bytes())
-            path_for_upload = mp4_path
+                    self._upload_instagram(video_path, caption)
+                except Exception:
+                    # Drop the client so the next poll logs in again
+                    self._ig_client = None
+                    raise
+
+    def _tiktok_cookies_file(self) -> str | None:
+        if self._tiktok_cookies is None:
+            self._tiktok_cookies = os.environ.get("TIKTOK_COOKIES_FILE")
+        return self._tiktok_cookies
+
+    def _upload_tiktok(self, video_path: Path, caption: str | None) -> None:
+        print("[uploader] uploading to tiktok")
+        cookies_file = self._tiktok_cookies_file()
+        description = caption or ""
 
         upload_video(
-            str(path_for_upload),
+            str(video_path),
             description=description,
             cookies=cookies_file,
             headless=True,
         )
-        return None
-    elif service == "instagram":
-        print("[uploader] uploading to instagram")
+
+    def _instagram_client(self) -> Client:
+        if self._ig_client is not None:
+            return self._ig_client
+
         username = os.environ.get("INSTAGRAM_USERNAME")
         password = os.environ.get("INSTAGRAM_PASSWORD")
 
@@ -165,20 +220,107 @@ def upload_to_service(service: str, video_path: Path, caption: str | None) -> No
         except Exception:
             pass
 
+        self._ig_client = cl
+        return cl
+
+    def _upload_instagram(self, video_path: Path, caption: str | None) -> None:
+        print("[uploader] uploading to instagram")
+        cl = self._instagram_client()
+
         # Upload as a Reel (recommended for most video uploads). Fallback to feed video if needed.
         cap = caption or ""
         cl.clip_upload(str(video_path), cap)
-        
-        return None
+
+
+# -----------------------
+# Workers
+# -----------------------
+
+# One queue and worker thread per service so a slow service (e.g. a stuck
+# TikTok browser session) never delays uploads to the others
+_uploader = Uploader()
+_queues: Dict[str, queue.Queue] = {}
+# (video_id, service) pairs queued or in progress; guards against re-enqueueing
+# work that a worker hasn't recorded a result for yet
+_pending: set[tuple[int, str]] = set()
+_pending_lock = threading.Lock()
+
+
+def service_queue(service: str) -> queue.Queue:
+    # Only called from the main loop thread
+    q = _queues.get(service)
+    if q is None:
+        q = _queues[service] = queue.Queue()
+        threading.Thread(target=worker, args=(service, q), name=f"uploader-{service}", daemon=True).start()
+    return q
+
+
+def enqueue(video_id: int, service: str) -> None:
+    key = (video_id, service)
+    with _pending_lock:
+        if key in _pending:
+            return
+        _pending.add(key)
+    service_queue(service).put(video_id)
+
+
+def mark_missing(db: sqlite3.Connection, video_id: int, service: str) -> None:
+    # Leave pairs a worker holds to that worker, and re-check the DB because a
+    # worker may have recorded a result after the producer's snapshot; workers
+    # only drop a pair from _pending under the lock after recording it
+    with _pending_lock:
+        if (video_id, service) in _pending or has_attempt(db, video_id, service):
+            return
+        mark_result(db, video_id, service, ok=False, error="file missing on disk")
+
+
+def worker(service: str, tasks: queue.Queue) -> None:
+    # Each worker owns its sqlite connection; connections can't be shared across
+    # threads. Opened lazily inside the loop so a failed connect (e.g. "database
+    # is locked") only fails the current task instead of killing the worker.
+    db = None
+    while True:
+        video_id = tasks.get()
+        try:
+            if db is None:
+                db = get_db()
+            row = db.execute("SELECT id, file_name, caption FROM videos WHERE id = ?", (video_id,)).fetchone()
+            # Skip videos deleted since they were queued, or recorded by an
+            # earlier task after the producer read its snapshot
+            if row is not None and not has_attempt(db, video_id, service):
+                upload_one(db, row, service)
+        except Exception as e:
+            print(f"[uploader] {service} worker error:", e)
+        finally:
+            with _pending_lock:
+                _pending.discard((video_id, service))
+            tasks.task_done()
+
+
+def upload_one(db: sqlite3.Connection, row: sqlite3.Row, service: str) -> None:
+    video_id = row["id"]
+    try:
+        _uploader.upload(service, video_file_path(row), row["caption"])
+        mark_result(db, video_id, service, ok=True)
+        print(f"[uploader] uploaded video {video_id} to {service}")
+    except Exception as e:
+        mark_result(db, video_id, service, ok=False, error=str(e))
+        print(f"[uploader] failed to upload video {video_id} to {service}: {e}")
+
 
 # -----------------------
 # Main loop
 # -----------------------
 
 def main_loop() -> None:
-    print("[uploader] starting background loop; poll interval:", 30, "s")
+    print("[uploader] starting background loop; poll interval:", POLL_INTERVAL, "s")
+    # Long-lived connection used only to detect commits from the web app;
+    # opened inside the loop so a locked database only delays a poll
+    watch_db = None
     while True:
         try:
+            if watch_db is None:
+                watch_db = get_db()
             db = get_db()
             ensure_schema(db)
 
@@ -186,54 +328,46 @@ def main_loop() -> None:
             if not svcs:
                 print("[uploader] no services enabled via API keys; sleeping...")
                 db.close()
-                time.sleep(30)
                 continue
 
-            # Find due videos (taken_at <= now)
+            # Find due videos (taken_at <= now) along with services already attempted
             cur = db.execute(
                 """
-                SELECT * FROM videos
-                WHERE taken_at BETWEEN
+                SELECT v.id, v.file_name, v.caption,
+                    (SELECT GROUP_CONCAT(vu.service) FROM video_uploads vu
+                     WHERE vu.video_id = v.id) AS attempted
+                FROM videos v
+                WHERE v.taken_at BETWEEN
                     strftime('%Y-%m-%dT%H:%M', 'now', '-24 hours', 'localtime') AND
                     strftime('%Y-%m-%dT%H:%M', 'now', 'localtime')
-                ORDER BY taken_at ASC
+                ORDER BY v.taken_at ASC
                 """
             )
             rows = cur.fetchall()
             print(f"[uploader] {len(rows)} due videos")
 
-
-
             for row in rows:
                 video_id = row["id"]
-                caption = row["caption"]
-                file_hash = row["file_hash"]
-                video_path = UPLOAD_DIR / file_hash
-                if not video_path.exists():
+                attempted = set((row["attempted"] or "").split(","))
+                if not video_file_path(row).exists():
                     # Mark once per service and skip repeat attempts
                     for svc in svcs:
-                        if not has_attempt(db, video_id, svc):
-                            mark_result(db, video_id, svc, ok=False, error="file missing on disk")
+                        if svc not in attempted:
+                            mark_missing(db, video_id, svc)
                     continue
 
                 for svc in svcs:
                     # If we've already attempted this service for this video
                     # (either success or failure), do not try again.
-                    if has_attempt(db, video_id, svc):
+                    if svc in attempted:
                         continue
-                    try:
-                        upload_to_service(svc, video_path, caption)
-                        mark_result(db, video_id, svc, ok=True)
-                        print(f"[uploader] uploaded video {video_id} to {svc}")
-                    except Exception as e:
-                        mark_result(db, video_id, svc, ok=False, error=str(e))
-                        print(f"[uploader] failed to upload video {video_id} to {svc}: {e}")
+                    enqueue(video_id, svc)
 
             db.close()
         except Exception as outer:
             print("[uploader] loop error:", outer)
         finally:
-            time.sleep(30)
+            wait_for_change(watch_db, POLL_INTERVAL)
 
 
 if __name__ == "__main__":